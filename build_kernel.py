@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Ahead-of-time compiles the Game of Life step kernel into the life_kernel extension module"""
+
+import os
+
+import numpy as np
+from numba.pycc import CC
+
+cc = CC("life_kernel")
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+# New state of a square, indexed by [current state, number of alive neighbours]
+RULES_LUT = np.array([[0, 0, 0, 1, 0, 0, 0, 0, 0],
+                      [0, 0, 1, 1, 0, 0, 0, 0, 0]], dtype=np.uint8)
+
+
+@cc.export("step", "u1[:,:](u1[:,:], u1[:,:])")
+def step(board, outputBoard):
+    """
+    Counts how many neighbouring squares are alive for each square and looks up the rules, wrapping at the edges
+    Kept in step with step_numba in the game script
+    :param board: numpy array
+        Contains the data of current board state
+    :param outputBoard: numpy array
+        Same shape as board, overwritten with the next game state
+    :return:
+        Returns outputBoard with the next game state data
+    """
+    height, width = board.shape
+    for i in range(height):
+        im, ip = (i - 1) % height, (i + 1) % height
+        for j in range(width):
+            jm, jp = (j - 1) % width, (j + 1) % width
+            count = (board[im, jm] + board[im, j] + board[im, jp] + board[i, jm] +
+                     board[i, jp] + board[ip, jm] + board[ip, j] + board[ip, jp])
+            outputBoard[i, j] = RULES_LUT[board[i, j], count]
+    return outputBoard
+
+
+if __name__ == "__main__":
+    """
+    Builds life_kernel next to this script, where the game will import it from
+    """
+    cc.compile()
+
+__author__ = "Louis De Neve"
+__status__ = "Development"
@@ -1,9 +1,31 @@
 #!/usr/bin/env python
 """Conways Game of Life - written for pygame"""
 
+from functools import lru_cache
+
 import numpy as np
 import pygame
 
+try:
+    from numba import njit, prange
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """
+        Stands in for numba.njit when numba is not installed
+        :return:
+            Returns a decorator that leaves the function uncompiled
+        """
+        return lambda func: func
+
+try:
+    from life_kernel import step as step_aot
+except ImportError:
+    step_aot = None
+
 
 # COLOURS
 WHITE = (255, 255, 255)
@@ -21,6 +43,21 @@ TICK_SPEED = 20
 # CUSTOM PYGAME EVENT
 TICK = pygame.USEREVENT + 1
 
+# GAME RULES
+# New state of a square, indexed by [current state, number of alive neighbours]
+RULES_LUT = np.array([[0, 0, 0, 1, 0, 0, 0, 0, 0],
+                      [0, 0, 1, 1, 0, 0, 0, 0, 0]], dtype=np.uint8)
+
+# KERNEL SETTINGS
+# Packing and unpacking every tick makes the bit-packed kernel slower than step_numba on small boards,
+# measured break even is around 64 x 64 squares
+SWAR_MIN_WIDTH = 64
+SWAR_MIN_CELLS = 4096
+
+# Constants for the bit-packed kernel, typed as uint64 so numba keeps its shifts and masks in unsigned 64 bit words
+ONE = np.uint64(1)
+SIXTY_THREE = np.uint64(63)
+
 
 def createBoard(width, height):
     """
@@ -30,35 +67,94 @@ def createBoard(width, height):
     :param height: integer
         Height of array
     :return:
-        Returns empty numpy array
+        Returns empty numpy array of unsigned bytes
     """
-    board = np.zeros((width, height))
+    board = np.zeros((width, height), dtype=np.uint8)
     return board
 
 
-def draw(board, surface, cellsize, border_size):
+def createRects(dim_x, dim_y, cellsize, border_size):
     """
-    Draws black squares on board
-    :param board: numpy array
-        Contains the data of current board state
-    :param surface: pygame surface
-        Background surface the squares are drawn on
+    Precomputes the on screen rect of every square, leaving the top row free for the menu bar
+    :param dim_x: integer
+        Number of horizontal cells
+    :param dim_y: integer
+        Number of vertical cells
     :param cellsize: integer
         Size of cells
     :param border_size: integer
         Width of borders
+    :return:
+        Returns nested list of pygame rects, indexed the same way as the board
+    """
+    xs = (border_size + np.arange(dim_y) * (cellsize + border_size)).tolist()
+    ys = (border_size + (np.arange(dim_x) + 1) * (cellsize + border_size)).tolist()
+    rects = [[pygame.Rect(x, y, cellsize, cellsize) for x in xs] for y in ys]
+    return rects
+
+
+def createTiles(surface, rects, cellsize):
+    """
+    Pre-renders the static background, with every square dead, and a single alive square
+    Both are converted to the display's pixel format so they can be blitted without conversion
+    :param surface: pygame surface
+        Display surface with the borders and menu bar already drawn
+    :param rects: nested list of pygame rects
+        On screen position of each square
+    :param cellsize: integer
+        Size of cells
+    :return:
+        Returns the background surface and the alive square surface
+    """
+    for row in rects:
+        for rect in row:
+            pygame.draw.rect(surface, BLACK, rect)
+    background = surface.copy().convert()
+    cell = pygame.Surface((cellsize, cellsize)).convert()
+    cell.fill(WHITE)
+    return background, cell
+
+
+def draw_square(alive, surface, rect, background, cell):
+    """
+    Draws a single square by blitting either the alive square or the matching area of the background
+    :param alive: integer (1 or 0)
+        1 = alive, 0 = dead
+    :param surface: pygame surface
+        Surface the square is drawn on
+    :param rect: pygame rect
+        On screen position of the square
+    :param background: pygame surface
+        Pre-rendered background with every square dead
+    :param cell: pygame surface
+        Pre-rendered alive square
+    :return:
+        Returns the rect that was drawn
+    """
+    if alive == 0:
+        return surface.blit(background, rect, area=rect)
+    return surface.blit(cell, rect)
+
+
+def draw(board, surface, rects, background, cell):
+    """
+    Draws every square on board
+    :param board: numpy array
+        Contains the data of current board state
+    :param surface: pygame surface
+        Background surface the squares are drawn on
+    :param rects: nested list of pygame rects
+        On screen position of each square
+    :param background: pygame surface
+        Pre-rendered background with every square dead
+    :param cell: pygame surface
+        Pre-rendered alive square
     :return:
         Returns populated numpy array
     """
     for i, x in enumerate(board):
         for j, y in enumerate(x):
-            if y == 0:
-                col = BLACK
-            else:
-                col = WHITE
-            pygame.draw.rect(surface, col, (border_size + j * (cellsize + border_size),
-                                            border_size + (i + 1) * (cellsize + border_size),
-                                            cellsize, cellsize))
+            draw_square(y, surface, rects[i][j], background, cell)
     return board
 
 
@@ -118,18 +214,9 @@ def pos_to_square(pos, cellsize, border_size, dim_x, dim_y):
     :return:
         Returns square index (tuple) and pause state (boolean)
     """
-    x, y = (int(pos[0] / (cellsize + border_size)), int(pos[1] / (cellsize + border_size)))
-
-    if x >= dim_y:
-        x = dim_y - 1
-    if y >= dim_x:
-        y = dim_x - 1
-
-    if x == y == 0:
-        pause = True
-    else:
-        pause = False
-
+    step_size = cellsize + border_size
+    x, y = min(pos[0] // step_size, dim_y - 1), min(pos[1] // step_size, dim_x - 1)
+    pause = x == y == 0
     square = (x, y - 1)
     return square, pause
 
@@ -152,66 +239,292 @@ def change_square(mainBoard, square):
     return mainBoard
 
 
-def rules(alive, count):
+def step_numpy(board, outputBoard):
     """
-    Applies Game of Life rules to determine a squares new state
-    :param alive: integer (1 or 0)
-        1 = alive, 0 = dead
-    :param count: integer
-        The number of neighbouring squares that are alive
+    Counts how many neighbouring squares are alive for each square and looks up the rules for the whole board at once
+    The board is padded once with wrapped edges, so squares on one edge neighbour those on the opposite edge,
+    and the neighbours are summed from views into the padded board rather than copies
+    :param board: numpy array
+        Contains the data of current board state
+    :param outputBoard: numpy array
+        Same shape as board, overwritten with the next game state
+    :return:
+        Returns outputBoard with the next game state data
+    """
+    padded = np.pad(board, 1, mode="wrap")
+    count = padded[:-2, :-2] + padded[:-2, 1:-1]
+    for neighbours in (padded[:-2, 2:], padded[1:-1, :-2], padded[1:-1, 2:],
+                       padded[2:, :-2], padded[2:, 1:-1], padded[2:, 2:]):
+        count += neighbours
+    outputBoard[:] = RULES_LUT[board, count]
+    return outputBoard
+
+
+@njit(cache=True, parallel=True)
+def step_numba(board, outputBoard):
+    """
+    Compiled equivalent of step_numpy, counting neighbours with wrapped indices rather than views of a padded board
+    Rows are shared out between cores
+    :param board: numpy array
+        Contains the data of current board state
+    :param outputBoard: numpy array
+        Same shape as board, overwritten with the next game state
+    :return:
+        Returns outputBoard with the next game state data
+    """
+    height, width = board.shape
+    for i in prange(height):
+        im, ip = (i - 1) % height, (i + 1) % height
+        for j in range(width):
+            jm, jp = (j - 1) % width, (j + 1) % width
+            count = (board[im, jm] + board[im, j] + board[im, jp] + board[i, jm] +
+                     board[i, jp] + board[ip, jm] + board[ip, j] + board[ip, jp])
+            outputBoard[i, j] = RULES_LUT[board[i, j], count]
+    return outputBoard
+
+
+@njit(cache=True)
+def step_fixed(board, outputBoard):
+    """
+    Equivalent of step_numba specialised for the default VERTICAL_CELLS x HORIZONTAL_CELLS board
+    The dimensions are compile time constants, so the loop bounds are fixed and wrapping needs no modulo
+    Like the other numba kernels it is only compiled the first time it is called
+    select_step only falls back to it when no life_kernel module has been built, as the ahead-of-time kernel
+    avoids JIT compilation on startup
+    :param board: numpy array
+        Contains the data of current board state, must be VERTICAL_CELLS x HORIZONTAL_CELLS
+    :param outputBoard: numpy array
+        Same shape as board, overwritten with the next game state
     :return:
-        Returns the new alive state of a square (integer [1 or 0]), as well as its colour (var)
+        Returns outputBoard with the next game state data
     """
-    if (alive == 1) and ((count == 2) or (count == 3)):
-        return 1, WHITE
-    elif (alive == 0) and (count == 3):
-        return 1, WHITE
+    for i in range(VERTICAL_CELLS):
+        im = i - 1 if i > 0 else VERTICAL_CELLS - 1
+        ip = i + 1 if i < VERTICAL_CELLS - 1 else 0
+        for j in range(HORIZONTAL_CELLS):
+            jm = j - 1 if j > 0 else HORIZONTAL_CELLS - 1
+            jp = j + 1 if j < HORIZONTAL_CELLS - 1 else 0
+            count = (board[im, jm] + board[im, j] + board[im, jp] + board[i, jm] +
+                     board[i, jp] + board[ip, jm] + board[ip, j] + board[ip, jp])
+            outputBoard[i, j] = RULES_LUT[board[i, j], count]
+    return outputBoard
+
+
+def pack_board(board):
+    """
+    Packs each row of the board into 64 bit words, one bit per square
+    Square j of a row is bit j % 64 of word j // 64, unused bits of the last word are left as 0
+    :param board: numpy array
+        Contains the data of current board state
+    :return:
+        Returns numpy array of uint64 words with one row per board row
+    """
+    height, width = board.shape
+    packed = np.zeros((height, -(-width // 64) * 8), dtype=np.uint8)
+    packed[:, :-(-width // 8)] = np.packbits(board, axis=1, bitorder="little")
+    return packed.view(np.dtype("<u8"))
+
+
+def unpack_board(packed, outputBoard):
+    """
+    Unpacks rows of 64 bit words back into one byte per square
+    :param packed: numpy array
+        Packed board state, as produced by pack_board
+    :param outputBoard: numpy array
+        Overwritten with the unpacked board state
+    :return:
+        Returns outputBoard with the unpacked board state
+    """
+    outputBoard[:] = np.unpackbits(packed.view(np.uint8), axis=1, count=outputBoard.shape[1], bitorder="little")
+    return outputBoard
+
+
+@njit(cache=True)
+def full_adder(a, b, c):
+    """
+    Adds three words bit by bit
+    :param a: uint64
+        First word
+    :param b: uint64
+        Second word
+    :param c: uint64
+        Third word
+    :return:
+        Returns the sum bits and carry bits
+    """
+    return a ^ b ^ c, (a & b) | (c & (a ^ b))
+
+
+@njit(cache=True)
+def shift_word(row, k, last, end):
+    """
+    Shifts word k of a packed row so each bit lines up with the square to its left and to its right
+    Bits are carried across neighbouring words and wrap around between the first and last square of the row
+    :param row: numpy array
+        Packed row
+    :param k: integer
+        Index of the word to shift
+    :param last: integer
+        Index of the last word in the row
+    :param end: uint64
+        Bit position of the last square within the last word
+    :return:
+        Returns words holding the left and right neighbour of each square
+    """
+    left = row[k] << ONE
+    if k > 0:
+        left |= row[k - 1] >> SIXTY_THREE
     else:
-        return 0, BLACK
+        left |= (row[last] >> end) & ONE
+    right = row[k] >> ONE
+    if k < last:
+        right |= row[k + 1] << SIXTY_THREE
+    else:
+        right |= (row[0] & ONE) << end
+    return left, right
 
 
-def tick(board, surface, cellsize, border_size):
+@njit(cache=True, parallel=True)
+def step_swar_packed(packed, outputPacked, width):
+    """
+    Applies the rules to a packed board, 64 squares at a time
+    The eight neighbours are summed into a 4 bit count per square using full adders over whole words
+    :param packed: numpy array
+        Packed board state, as produced by pack_board
+    :param outputPacked: numpy array
+        Same shape as packed, overwritten with the next packed game state
+    :param width: integer
+        Number of squares in each row
+    :return:
+        Returns outputPacked with the next packed game state
     """
-    Counts how many neighbouring squares are alive for each square, and calls Rules on each one
-    Additionally draws the squares for the next frame
+    height, words = packed.shape
+    last = words - 1
+    end = np.uint64((width - 1) % 64)
+    mask = ~np.uint64(0) >> (SIXTY_THREE - end)
+    for i in prange(height):
+        above, row, below = packed[(i - 1) % height], packed[i], packed[(i + 1) % height]
+        for k in range(words):
+            aL, aR = shift_word(above, k, last, end)
+            mL, mR = shift_word(row, k, last, end)
+            bL, bR = shift_word(below, k, last, end)
+            t0, t1 = full_adder(aL, above[k], aR)
+            b0, b1 = full_adder(bL, below[k], bR)
+            m0, m1 = mL ^ mR, mL & mR
+            s0, c1 = full_adder(t0, m0, b0)
+            x, y = full_adder(t1, m1, b1)
+            s1, z = x ^ c1, x & c1
+            s2, s3 = y ^ z, y & z
+            outputPacked[i, k] = s1 & ~(s2 | s3) & (s0 | row[k])
+        outputPacked[i, last] &= mask
+    return outputPacked
+
+
+def step_swar(board, outputBoard):
+    """
+    Packs the board into bits, applies the rules with step_swar_packed and unpacks the result
     :param board: numpy array
         Contains the data of current board state
+    :param outputBoard: numpy array
+        Same shape as board, overwritten with the next game state
+    :return:
+        Returns outputBoard with the next game state data
+    """
+    packed = pack_board(board)
+    outputPacked = step_swar_packed(packed, np.empty_like(packed), board.shape[1])
+    return unpack_board(outputPacked, outputBoard)
+
+
+@lru_cache(maxsize=None)
+def select_step(shape):
+    """
+    Chooses the fastest available kernel for a board shape
+    Bit packing only pays off on boards of at least SWAR_MIN_CELLS squares whose rows fill a 64 bit word,
+    as the board is packed and unpacked on every tick. Otherwise the ahead-of-time compiled kernel from
+    build_kernel.py is preferred whenever it has been built, as it needs no JIT compilation on startup,
+    followed by the kernel specialised for the default board size
+    :param shape: tuple
+        Shape of the board
+    :return:
+        Returns the kernel function
+    """
+    if NUMBA and shape[1] >= SWAR_MIN_WIDTH and shape[0] * shape[1] >= SWAR_MIN_CELLS:
+        return step_swar
+    if step_aot is not None:
+        return step_aot
+    if NUMBA and shape == (VERTICAL_CELLS, HORIZONTAL_CELLS):
+        return step_fixed
+    if NUMBA:
+        return step_numba
+    return step_numpy
+
+
+def step(board, outputBoard):
+    """
+    Calculates the next game state with the kernel chosen for the board's shape
+    :param board: numpy array
+        Contains the data of current board state
+    :param outputBoard: numpy array
+        Same shape as board, overwritten with the next game state
+    :return:
+        Returns outputBoard with the next game state data
+    """
+    return select_step(board.shape)(board, outputBoard)
+
+
+def render_diff(board, outputBoard, surface, rects, background, cell):
+    """
+    Redraws only the squares whose state differs between two boards
+    :param board: numpy array
+        Contains the data of the board state currently on screen
+    :param outputBoard: numpy array
+        Contains the data of the board state to be drawn
+    :param surface: pygame surface
+        Surface on which changed squares are drawn
+    :param rects: nested list of pygame rects
+        On screen position of each square
+    :param background: pygame surface
+        Pre-rendered background with every square dead
+    :param cell: pygame surface
+        Pre-rendered alive square
+    :return:
+        Returns list of the rects that were redrawn
+    """
+    dirty = []
+    for i, j in np.argwhere(board != outputBoard):
+        dirty.append(draw_square(outputBoard[i, j], surface, rects[i][j], background, cell))
+    return dirty
+
+
+def tick(board, outputBoard, surface, rects, background, cell):
+    """
+    Calculates the next game state, then draws and updates only the squares that changed
+    :param board: numpy array
+        Contains the data of current board state
+    :param outputBoard: numpy array
+        Same shape as board, overwritten with the next game state
     :param surface: pygame surface
         Surface on which new squares are drawn
-    :param cellsize: integer
-        Size of Cells
-    :param border_size: integer
-        Width of borders
+    :param rects: nested list of pygame rects
+        On screen position of each square
+    :param background: pygame surface
+        Pre-rendered background with every square dead
+    :param cell: pygame surface
+        Pre-rendered alive square
     :return:
         Returns updated numpy array with new game state data
     """
-    width, height = np.shape(board)
-    outputBoard = np.copy(board)
-    for i, x in enumerate(board):
-        for j, y in enumerate(x):
-            count = 0
-            nPos = [(i - 1, j), (i - 1, j - 1), (i, j - 1), (i + 1, j - 1), (i + 1, j), (i + 1, j + 1), (i, j + 1),
-                    (i - 1, j + 1)]
-            for neighbour in nPos:
-                if neighbour[0] == width:
-                    neighbour = (0, neighbour[1])
-                if neighbour[1] == height:
-                    neighbour = (neighbour[0], 0)
-                if board[neighbour] == 1:
-                    count += 1
-            outputBoard[i, j] = rules(y, count)[0]
-            outputBoard[i, j], col = rules(y, count)
-            pygame.draw.rect(surface, col, (border_size + j * (cellsize + border_size),
-                                            border_size + (i + 1) * (cellsize + border_size),
-                                            cellsize, cellsize))
+    outputBoard = step(board, outputBoard)
+    pygame.display.update(render_diff(board, outputBoard, surface, rects, background, cell))
     return outputBoard
 
 
-def paused(mainBoard, surface, cellsize, border_size, dimx, dimy):
+def paused(buffers, surface, cellsize, border_size, dimx, dimy, rects, background, cell):
     """
-    Executes state changes on click, unpauses the game, and sets new events to register the next tick
-    :param mainBoard: numpy array
-        Contains the data of current board state
+    Stops the tick timer while paused, executes state changes on click, unpauses the game,
+    and sets new events to register the next tick
+    :param buffers: list of two numpy arrays
+        The first contains the data of current board state, the second is scratch space for the next tick
     :param surface: pygame surface
         Surface on which new squares are drawn
     :param cellsize: integer
@@ -222,12 +535,19 @@ def paused(mainBoard, surface, cellsize, border_size, dimx, dimy):
         Number of horizontal cells
     :param dimy: integer
         Number of vertical cells
+    :param rects: nested list of pygame rects
+        On screen position of each square
+    :param background: pygame surface
+        Pre-rendered background with every square dead
+    :param cell: pygame surface
+        Pre-rendered alive square
     """
+    pygame.time.set_timer(TICK, 0)
     draw_play(surface, border_size, cellsize)
     p = True
     while p:
 
-        for event in pygame.event.get():
+        for event in [pygame.event.wait()] + pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 return
@@ -237,21 +557,21 @@ def paused(mainBoard, surface, cellsize, border_size, dimx, dimy):
                     square, pause = pos_to_square(pos, cellsize, border_size, dimx, dimy)
                     if pause:
                         pygame.time.set_timer(TICK, TICK_SPEED)
-                        play(mainBoard, surface, cellsize, border_size, dimx, dimy)
+                        play(buffers, surface, cellsize, border_size, dimx, dimy, rects, background, cell)
                         p = False
                     elif square[1] == -1:
                         pass
                     else:
-                        mainBoard = change_square(mainBoard, square)
-                        mainBoard = draw(mainBoard, surface, cellsize, border_size)
+                        change_square(buffers[0], square)
+                        draw(buffers[0], surface, rects, background, cell)
                         pygame.display.update()
 
 
-def play(mainBoard, surface, cellsize, border_size, dimx, dimy):
+def play(buffers, surface, cellsize, border_size, dimx, dimy, rects, background, cell):
     """
     Execute ticks every event loop, and identifies if the game needs to be paused
-    :param mainBoard: numpy array
-        Contains the data of current board state
+    :param buffers: list of two numpy arrays
+        The first contains the data of current board state, the second is scratch space for the next tick
     :param surface: pygame surface
         Surface on which new squares are drawn
     :param cellsize: integer
@@ -262,12 +582,18 @@ def play(mainBoard, surface, cellsize, border_size, dimx, dimy):
         Number of horizontal cells
     :param dimy: integer
         Number of vertical cells
+    :param rects: nested list of pygame rects
+        On screen position of each square
+    :param background: pygame surface
+        Pre-rendered background with every square dead
+    :param cell: pygame surface
+        Pre-rendered alive square
     """
     draw_pause(surface, border_size, cellsize)
     t = True
     while t:
         pause, speed = False, False
-        for event in pygame.event.get():
+        for event in [pygame.event.wait()] + pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 return
@@ -276,11 +602,11 @@ def play(mainBoard, surface, cellsize, border_size, dimx, dimy):
                     pos = pygame.mouse.get_pos()
                     square, pause = pos_to_square(pos, cellsize, border_size, dimx, dimy)
             if event.type == TICK:
-                mainBoard = tick(np.copy(mainBoard), surface, cellsize, border_size)
-                pygame.display.update()
+                tick(buffers[0], buffers[1], surface, rects, background, cell)
+                buffers.reverse()
                 pygame.time.set_timer(TICK, TICK_SPEED)
         if pause:
-            paused(mainBoard, surface, cellsize, border_size, dimx, dimy)
+            paused(buffers, surface, cellsize, border_size, dimx, dimy, rects, background, cell)
             t = False
         else:
             pass
@@ -307,9 +633,12 @@ def init(mainBoard, dim_x, dim_y):
     pygame.draw.rect(surface, LIGHTGRAY,
                      (2 * border_size + 1 * cellsize, border_size, (cellsize + border_size) * dim_y - border_size,
                       cellsize))
-    mainBoard = draw(mainBoard, surface, cellsize, border_size)
+    rects = createRects(dim_x, dim_y, cellsize, border_size)
+    background, cell = createTiles(surface, rects, cellsize)
+    mainBoard = draw(mainBoard, surface, rects, background, cell)
     pygame.display.update()
-    paused(mainBoard, surface, cellsize, border_size, dim_x, dim_y)
+    buffers = [mainBoard, np.empty_like(mainBoard)]
+    paused(buffers, surface, cellsize, border_size, dim_x, dim_y, rects, background, cell)
 
 
 if __name__ == "__main__":